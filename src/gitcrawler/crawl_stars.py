@@ -2,20 +2,29 @@ from __future__ import annotations
 
 import argparse
 import math
+import multiprocessing
 import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from datetime import datetime, timedelta, date
-from typing import List, Sequence
+from typing import Dict, List, Sequence, Tuple
 
-from .github import count_for_query, iter_search, fetch_repo, get_rate_limit
-from .db import get_conn, upsert_repo, export_csv
-from .utils import TransientError
+from .github import COUNT_BATCH_SIZE, SEARCH_PAGE_SIZE, SEARCH_RESULT_CAP, count_for_query, count_for_queries, iter_search, iter_search_concurrent, fetch_repo, get_rate_limit, get_token_pool, set_count_cache_enabled
+from .db import COPY_THRESHOLD, get_conn, repositories_empty, upsert_repos_bulk, write_repos, export_csv
+from .utils import TransientError, get_session
 
 TARGET_REPOS = 100_000
 JOB_DIVISOR = 2_100_000
 BUCKET_OVERSHOOT = 1.4
 JOB_OVERSHOOT = 1.2
+COUNT_CONCURRENCY = 10
+SPLIT_SAFETY = 1.2
+MAX_SPLIT_PARTS = COUNT_BATCH_SIZE
+STREAM_CHUNK_SIZE = 100
+WRITER_BATCH_SIZE = 500
+
+# (repo_id, owner, name, stars, url): flat tuples pickle smaller and faster than dicts across processes.
+RepoRow = Tuple[str, str, str, int, str]
 
 
 @dataclass(frozen=True)
@@ -25,47 +34,94 @@ class Bucket:
     approx_count: int
 
 
-def _count_range(start: date, end: date) -> int:
-    q = f"created:{start.isoformat()}..{end.isoformat()}"
+def _range_query(start: date, end: date) -> str:
+    return f"created:{start.isoformat()}..{end.isoformat()}"
+
+
+def _count_ranges(ranges: Sequence[tuple[date, date]]) -> List[int]:
+    qs = [_range_query(start, end) for start, end in ranges]
     for attempt in range(6):
         try:
-            return count_for_query(q)
+            return count_for_queries(qs)
         except TransientError as exc:
             wait_seconds = min(300, 30 * (attempt + 1))
             print(
-                f"Count query throttled for range {q} ({exc}); sleeping {wait_seconds}s before retry.",
+                f"Count query throttled for ranges {qs[0]} (+{len(qs) - 1} more) ({exc}); sleeping {wait_seconds}s before retry.",
                 flush=True,
             )
             time.sleep(wait_seconds)
-    raise TransientError(f"Failed to count range {q} after multiple retries.")
-
-
-def split_buckets(start: date, end: date, threshold: int, target: int, overshoot: float) -> List[Bucket]:
-    """Iteratively split ranges until each bucket is under threshold or we have enough coverage."""
+    raise TransientError(f"Failed to count ranges {qs[0]} (+{len(qs) - 1} more) after multiple retries.")
+
+
+def _split_parts(count: int, threshold: int, start: date, end: date, scaling: float) -> int:
+    """How many equal sub-ranges to cut a range into so each is expected to land under threshold."""
+    parts = math.ceil(count / max(1, threshold) * SPLIT_SAFETY * scaling)
+    # Capped so one split is one aliased count request and sparse stretches of a wide range stay coarse.
+    return max(2, min(parts, MAX_SPLIT_PARTS, (end - start).days + 1))
+
+
+def _split_range(start: date, end: date, parts: int) -> List[tuple[date, date]]:
+    base, extra = divmod((end - start).days + 1, parts)
+    ranges: List[tuple[date, date]] = []
+    current = start
+    for i in range(parts):
+        length = base + (1 if i < extra else 0)
+        ranges.append((current, current + timedelta(days=length - 1)))
+        current += timedelta(days=length)
+    return ranges
+
+
+def split_buckets(
+    start: date,
+    end: date,
+    threshold: int,
+    target: int,
+    overshoot: float,
+) -> List[Bucket]:
+    """Split ranges in date order, counting one wave of ranges concurrently at a time, until each bucket is under threshold or we have enough coverage."""
+    # Kept in date order; split children go back to the front so the earliest ranges are resolved first.
     pending: List[tuple[date, date]] = [(start, end)]
     buckets: List[Bucket] = []
     approx_accum = 0
     target_limit = int(target * overshoot)
+    wave_size = COUNT_CONCURRENCY * COUNT_BATCH_SIZE
+    # child range -> (parent range, expected count for an even split of the parent)
+    parent_of: Dict[tuple[date, date], tuple[tuple[date, date], float]] = {}
+    scaling = 1.0
 
     while pending and approx_accum < target_limit:
-        current_start, current_end = pending.pop()
-        count = _count_range(current_start, current_end)
-        if count <= threshold or current_start >= current_end:
-            buckets.append(Bucket(current_start, current_end, count))
-            effective = max(1, min(count, threshold))
-            approx_accum += effective
-            continue
-        print(
-            f"Splitting bucket {current_start.isoformat()}..{current_end.isoformat()} (≈{count} repos)",
-            flush=True,
-        )
-        span_days = (current_end - current_start).days
-        mid = current_start + timedelta(days=span_days // 2)
-        right_start = (mid + timedelta(days=1))
-        if right_start > current_end:
-            right_start = current_end
-        pending.append((right_start, current_end))
-        pending.append((current_start, mid))
+        wave, pending = pending[:wave_size], pending[wave_size:]
+        # Ranges are counted COUNT_BATCH_SIZE at a time in one aliased request; batches run concurrently.
+        batches = [wave[i: i + COUNT_BATCH_SIZE] for i in range(0, len(wave), COUNT_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=COUNT_CONCURRENCY) as executor:
+            counts = [n for batch_counts in executor.map(_count_ranges, batches) for n in batch_counts]
+        # Density is rarely uniform: scale later splits by how far the densest child overshot its even share.
+        skews: Dict[tuple[date, date], float] = {}
+        for r, count in zip(wave, counts):
+            if r in parent_of:
+                parent, expected = parent_of.pop(r)
+                if expected > 0:
+                    skews[parent] = max(skews.get(parent, 0.0), count / expected)
+        if skews:
+            scaling = max(1.0, sum(skews.values()) / len(skews))
+        children: List[tuple[date, date]] = []
+        for (current_start, current_end), count in zip(wave, counts):
+            if approx_accum >= target_limit:
+                break
+            if count <= threshold or current_start >= current_end:
+                buckets.append(Bucket(current_start, current_end, count))
+                effective = max(1, min(count, threshold))
+                approx_accum += effective
+                continue
+            parts = _split_parts(count, threshold, current_start, current_end, scaling)
+            print(
+                f"Splitting bucket {current_start.isoformat()}..{current_end.isoformat()} (≈{count} repos) into {parts} parts",
+                flush=True,
+            )
+            for child in _split_range(current_start, current_end, parts):
+                parent_of[child] = ((current_start, current_end), count / parts)
+                children.append(child)
+        pending = children + pending
 
     buckets.sort(key=lambda b: b.start)
     return buckets
@@ -79,76 +135,109 @@ def parse_date(value: str) -> date:
     return datetime.strptime(value, "%Y-%m-%d").date()
 
 
-def plan_jobs_evenly(buckets: Sequence[Bucket], job_count: int) -> List[List[Bucket]]:
-    if job_count <= 0:
-        job_count = 1
-    job_count = min(job_count, len(buckets)) or 1
-    jobs: List[List[Bucket]] = []
-    base = len(buckets) // job_count
-    remainder = len(buckets) % job_count
-    idx = 0
-    for i in range(job_count):
-        take = base + (1 if i < remainder else 0)
-        if take <= 0:
-            continue
-        jobs.append(list(buckets[idx: idx + take]))
-        idx += take
-    return [job for job in jobs if job]
-
-
-def _process_job(job_id: int, buckets: Sequence[Bucket], job_target: int):
-    collected = []
-    if not buckets or job_target <= 0:
-        return job_id, collected
-
-    for bucket in buckets:
-        if len(collected) >= job_target:
+def _repo_row(repo: dict) -> RepoRow:
+    return (repo["id"], repo["owner"]["login"], repo["name"], repo["stargazerCount"], repo["url"])
+
+
+def _row_to_dict(row: RepoRow) -> dict:
+    repo_id, owner, name, stars, url = row
+    return {"id": repo_id, "owner": owner, "name": name, "stars": stars, "url": url}
+
+
+def plan_bucket_targets(buckets: Sequence[Bucket], target: int) -> List[int]:
+    """Fill the densest buckets to what they can return until target * JOB_OVERSHOOT is covered; the rest get 0."""
+    budget = math.ceil(target * JOB_OVERSHOOT)
+    targets = [0 for _ in buckets]
+    for i in sorted(range(len(buckets)), key=lambda i: -buckets[i].approx_count):
+        if budget <= 0:
             break
-        query = f"created:{bucket.start.isoformat()}..{bucket.end.isoformat()}"
-        remaining = job_target - len(collected)
-        while True:
-            try:
-                for repo in iter_search(query, max_items=remaining):
-                    collected.append({
-                        "id": repo["id"],
-                        "owner": repo["owner"]["login"],
-                        "name": repo["name"],
-                        "stars": repo["stargazerCount"],
-                        "url": repo["url"],
-                    })
-                    if len(collected) >= job_target:
-                        break
-                break
-            except TransientError as exc:
-                wait_seconds = 90
-                print(f"Job {job_id} hit rate limiting ({exc}); sleeping {wait_seconds}s before retry.", flush=True)
-                time.sleep(wait_seconds)
-                remaining = job_target - len(collected)
-                if remaining <= 0:
+        capacity = min(max(0, buckets[i].approx_count), SEARCH_RESULT_CAP)
+        # Whole pages only: a partial share still pays for the full 100-node page.
+        targets[i] = min(capacity, math.ceil(budget / SEARCH_PAGE_SIZE) * SEARCH_PAGE_SIZE)
+        budget -= targets[i]
+    return targets
+
+
+def _init_worker():
+    """Build this worker's HTTP session and token pool once, before its first bucket."""
+    get_session()
+    get_token_pool()
+
+
+def _process_bucket(bucket: Bucket, bucket_target: int, results_queue):
+    """Fetch up to bucket_target repos and stream them to the writer in chunks; returns how many were fetched."""
+    fetched = 0
+    if bucket_target <= 0:
+        return bucket, fetched
+
+    query = _range_query(bucket.start, bucket.end)
+    chunk: List[RepoRow] = []
+    seen: set[str] = set()
+    while True:
+        try:
+            # A retry restarts from the first page; already-seen ids are skipped below.
+            for repo in iter_search_concurrent(query, max_items=bucket_target, approx_count=bucket.approx_count):
+                repo_id = repo["id"]
+                if repo_id in seen:
+                    continue
+                seen.add(repo_id)
+                chunk.append(_repo_row(repo))
+                fetched += 1
+                if len(chunk) >= STREAM_CHUNK_SIZE:
+                    results_queue.put(chunk)
+                    chunk = []
+                if fetched >= bucket_target:
                     break
-    return job_id, collected
+            break
+        except TransientError as exc:
+            wait_seconds = 90
+            print(f"Bucket {query} hit rate limiting ({exc}); sleeping {wait_seconds}s before retry.", flush=True)
+            time.sleep(wait_seconds)
+            if fetched >= bucket_target:
+                break
+    if chunk:
+        results_queue.put(chunk)
+    return bucket, fetched
 
 
-def _write_results(repos: List[dict]):
-    if not repos:
+def db_writer(results_queue, target: int, written):
+    """Drain streamed chunks, dedupe by id and upsert in batches until a None sentinel arrives."""
+    seen_ids = set()
+    batch: List[RepoRow] = []
+    with get_conn() as conn:
+        # Cold start: every row is new, so buffer COPY-sized batches and take the staging-table fast path.
+        batch_size = COPY_THRESHOLD if repositories_empty(conn) else WRITER_BATCH_SIZE
+        while True:
+            chunk = results_queue.get()
+            if chunk is None:
+                break
+            for row in chunk:
+                if row[0] in seen_ids or len(seen_ids) >= target:
+                    continue
+                seen_ids.add(row[0])
+                batch.append(row)
+            if len(batch) >= batch_size:
+                write_repos(conn, [_row_to_dict(row) for row in batch])
+                conn.commit()
+                written.value += len(batch)
+                batch = []
+        if batch:
+            write_repos(conn, [_row_to_dict(row) for row in batch])
+            conn.commit()
+            written.value += len(batch)
+
+
+def _write_results(rows: List[RepoRow]):
+    if not rows:
         print("No repositories collected; skipping DB write.")
         return
     with get_conn() as conn:
-        for repo in repos:
-            upsert_repo(conn, repo)
+        write_repos(conn, [_row_to_dict(row) for row in rows])
 
 
 def run_simple(query: str, target: int):
     print(f"Running simple crawl with query '{query}' (target={target}).")
-    collected = []
-    for repo in iter_search(query, max_items=target):
-        collected.append({
-                "id": repo["id"],
-                "owner": repo["owner"]["login"],
-                "name": repo["name"],
-                "stars": repo["stargazerCount"],
-                "url": repo["url"],
-            })
+    collected = [_repo_row(repo) for repo in iter_search(query, max_items=target)]
     _write_results(collected)
     print(f"Done. Inserted/updated {len(collected)} repos.")
 
@@ -162,6 +251,7 @@ def main():
     parser.add_argument("--recent-days", type=int, help="Shortcut to set --since to N days ago")
     parser.add_argument("--bucket-threshold", type=int, default=900, help="Maximum repo count per bucket before splitting")
     parser.add_argument("--simple", action="store_true", help="Skip bucketing and use a single search query (best with --recent-days)")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore the on-disk bucket count cache and always query GitHub")
     args = parser.parse_args()
 
     if args.export:
@@ -169,6 +259,9 @@ def main():
         print(f"Exported to {args.out}")
         return
 
+    if args.no_cache:
+        set_count_cache_enabled(False)
+
     if args.since and args.recent_days:
         raise SystemExit("Use either --since or --recent-days, not both.")
 
@@ -193,13 +286,7 @@ def main():
             print(f"Repository {args.repo} not found or inaccessible.")
             return
         with get_conn() as conn:
-            upsert_repo(conn, {
-                "id": repo["id"],
-                "owner": repo["owner"]["login"],
-                "name": repo["name"],
-                "stars": repo["stargazerCount"],
-                "url": repo["url"],
-            })
+            upsert_repos_bulk(conn, [_row_to_dict(_repo_row(repo))])
         print(f"Inserted/updated single repo {repo['owner']['login']}/{repo['name']}.")
         return
 
@@ -211,7 +298,7 @@ def main():
     rl_limit = rate_limit.get("limit") or rate_limit.get("remaining") or 1
     job_count = max(1, math.ceil(JOB_DIVISOR / rl_limit))
     print(f"Current rate limit: limit={rate_limit.get('limit')} remaining={rate_limit.get('remaining')} resetAt={rate_limit.get('resetAt')}")
-    print(f"Planning to create {job_count} job(s) based on 2,100,000 / rate_limit.")
+    print(f"Planning up to {job_count} parallel job(s) based on 2,100,000 / rate_limit.")
 
     if simple_mode:
         query = f"created:>={since.isoformat()} sort:stars"
@@ -238,42 +325,51 @@ def main():
     approx_total = sum(max(1, b.approx_count) for b in buckets)
     print(f"Built {len(buckets)} buckets covering ≈{approx_total} repos.")
 
-    jobs = plan_jobs_evenly(buckets, job_count)
-    if not jobs:
-        print("No jobs to execute; exiting.")
+    if not buckets:
+        print("No buckets to crawl; exiting.")
         return
 
     max_parallel = max(1, min(8, rl_limit // 500 if rl_limit else 1))
-    workers = min(len(jobs), max_parallel)
-
-    print(f"Launching {workers} worker process(es) across {len(jobs)} job(s) to reach target {target}.")
-
-    job_target = max(1, math.ceil((target * JOB_OVERSHOOT) / len(jobs)))
-    collected: List[dict] = []
-    seen_ids = set()
-    with ProcessPoolExecutor(max_workers=workers) as executor:
-        futures = []
-        for job_id, job_buckets in enumerate(jobs, start=1):
-            futures.append(executor.submit(_process_job, job_id, job_buckets, job_target))
-
-        for future in as_completed(futures):
-            job_id, results = future.result()
-            print(f"Job {job_id} collected {len(results)} repos.")
-            for repo in results:
-                if repo["id"] in seen_ids:
-                    continue
-                seen_ids.add(repo["id"])
-                collected.append(repo)
-                if len(collected) >= target:
-                    break
-            if len(collected) >= target:
-                break
-
-    if len(collected) > target:
-        collected = collected[:target]
-
-    _write_results(collected)
-    print(f"Done. Inserted/updated {len(collected)} repos (target {target}).")
+    workers = min(len(buckets), job_count, max_parallel)
+
+    print(f"Launching {workers} worker process(es) across {len(buckets)} bucket(s) to reach target {target}.")
+
+    bucket_targets = plan_bucket_targets(buckets, target)
+    fetched = 0
+    written = multiprocessing.Value("i", 0)
+    with multiprocessing.Manager() as manager:
+        # Manager queue puts are synchronous, so a finished bucket's rows are queued before its future resolves.
+        results_queue = manager.Queue()
+        writer = multiprocessing.Process(target=db_writer, args=(results_queue, target, written))
+        writer.start()
+        try:
+            # One task per bucket so idle workers pick up the next bucket; largest first to shorten the tail.
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+                futures = [
+                    executor.submit(_process_bucket, bucket, bucket_target, results_queue)
+                    for bucket, bucket_target in sorted(zip(buckets, bucket_targets), key=lambda p: -p[0].approx_count)
+                    if bucket_target > 0
+                ]
+                try:
+                    for future in as_completed(futures):
+                        if not writer.is_alive():
+                            print("DB writer stopped; cancelling remaining buckets.", flush=True)
+                            break
+                        bucket, count = future.result()
+                        fetched += count
+                        print(f"Bucket {bucket.start.isoformat()}..{bucket.end.isoformat()} collected {count} repos.")
+                        if fetched >= target:
+                            break
+                finally:
+                    executor.shutdown(wait=True, cancel_futures=True)
+        finally:
+            # Always release the writer so it flushes its last batch before the Manager goes away.
+            results_queue.put(None)
+            writer.join()
+
+    if writer.exitcode != 0:
+        raise SystemExit(f"DB writer exited with code {writer.exitcode}; {written.value} repos were committed before the failure.")
+    print(f"Done. Inserted/updated {written.value} repos (target {target}).")
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 from __future__ import annotations
 import os
+from contextlib import nullcontext
 from datetime import date
 
 import psycopg
@@ -7,44 +8,126 @@ from psycopg.rows import dict_row
 
 from .config import SETTINGS
 
+UPSERT_BATCH_SIZE = 1000
+COPY_THRESHOLD = 5000
+
 def get_conn():
     return psycopg.connect(SETTINGS.database_url, row_factory=dict_row)
 
-def upsert_repo(conn, repo):
-    # repo: dict with keys: id, owner, name, stars, url
+def _values_sql(row_count: int, template: str) -> str:
+    return ",\n".join([template] * row_count)
+
+def _generate_upsert_sql(row_count: int) -> str:
+    return f'''
+            INSERT INTO repositories (repo_id, owner, name, stars, html_url, updated_at, first_seen)
+            VALUES {_values_sql(row_count, "(%s, %s, %s, %s, %s, now(), now())")}
+            ON CONFLICT (repo_id) DO UPDATE
+            SET stars = EXCLUDED.stars,
+                html_url = EXCLUDED.html_url,
+                updated_at = now()
+            '''
+
+def _history_if_changed_sql(source: str) -> str:
+    # Only append history when stars differ from the latest captured value (newest row via the PK index).
+    return f'''
+            INSERT INTO repo_star_history (repo_id, stars, captured_at)
+            SELECT v.repo_id, v.stars, v.captured_at
+            FROM ({source}) AS v (repo_id, stars, captured_at)
+            LEFT JOIN LATERAL (
+                SELECT h.stars
+                FROM repo_star_history h
+                WHERE h.repo_id = v.repo_id
+                ORDER BY h.captured_at DESC
+                LIMIT 1
+            ) AS last ON true
+            WHERE last.stars IS DISTINCT FROM v.stars
+            ON CONFLICT (repo_id, captured_at) DO NOTHING
+            '''
+
+def _generate_history_sql(row_count: int) -> str:
+    return _history_if_changed_sql("VALUES " + _values_sql(row_count, "(%s::text, %s::integer, %s::date)"))
+
+def upsert_repos_bulk(conn, repos, batch_size: int = UPSERT_BATCH_SIZE):
+    # repos: iterable of dicts with keys: id, owner, name, stars, url
+    # A multi-row ON CONFLICT DO UPDATE cannot touch the same row twice, so dedupe first (last wins).
+    unique = list({repo["id"]: repo for repo in repos}.values())
+    captured_at = date.today()
+    # Pipeline mode sends every chunk's statements without waiting on each result (needs libpq >= 14).
+    pipeline = conn.pipeline() if psycopg.Pipeline.is_supported() else nullcontext()
+    with pipeline, conn.cursor() as cur:
+        for offset in range(0, len(unique), batch_size):
+            chunk = unique[offset: offset + batch_size]
+            cur.execute(
+                _generate_upsert_sql(len(chunk)),
+                [v for r in chunk for v in (r["id"], r["owner"], r["name"], r["stars"], r["url"])],
+            )
+            # Append to history only if stars changed since the last capture
+            cur.execute(
+                _generate_history_sql(len(chunk)),
+                [v for r in chunk for v in (r["id"], r["stars"], captured_at)],
+            )
+    return len(unique)
+
+def repositories_empty(conn) -> bool:
     with conn.cursor() as cur:
+        cur.execute("SELECT NOT EXISTS (SELECT 1 FROM repositories) AS empty")
+        return cur.fetchone()["empty"]
+
+def bulk_load_via_copy(conn, repos):
+    # Stream rows into a temp staging table with binary COPY, then merge with a single INSERT ... SELECT.
+    captured_at = date.today()
+    with conn.cursor() as cur:
+        cur.execute(
+            '''
+            CREATE TEMP TABLE _repo_stage (
+                repo_id TEXT NOT NULL,
+                owner   TEXT NOT NULL,
+                name    TEXT NOT NULL,
+                stars   INTEGER NOT NULL,
+                html_url TEXT
+            ) ON COMMIT DROP
+            '''
+        )
+        with cur.copy("COPY _repo_stage (repo_id, owner, name, stars, html_url) FROM STDIN (FORMAT BINARY)") as cp:
+            cp.set_types(["text", "text", "text", "int4", "text"])
+            for r in repos:
+                cp.write_row((r["id"], r["owner"], r["name"], r["stars"], r["url"]))
         cur.execute(
             '''
             INSERT INTO repositories (repo_id, owner, name, stars, html_url, updated_at, first_seen)
-            VALUES (%(id)s, %(owner)s, %(name)s, %(stars)s, %(url)s, now(), now())
+            SELECT DISTINCT ON (repo_id) repo_id, owner, name, stars, html_url, now(), now()
+            FROM _repo_stage
             ON CONFLICT (repo_id) DO UPDATE
             SET stars = EXCLUDED.stars,
                 html_url = EXCLUDED.html_url,
                 updated_at = now()
-            ''',
-            repo
+            '''
         )
-        # Append to history only if changed today not already captured
+        loaded = cur.rowcount
         cur.execute(
-            '''
-            INSERT INTO repo_star_history (repo_id, stars, captured_at)
-            VALUES (%(id)s, %(stars)s, %(captured_at)s)
-            ON CONFLICT (repo_id, captured_at) DO NOTHING
-            ''',
-            {"id": repo["id"], "stars": repo["stars"], "captured_at": date.today()}
+            _history_if_changed_sql("SELECT DISTINCT ON (repo_id) repo_id, stars, %s::date FROM _repo_stage"),
+            (captured_at,)
         )
+        # ON COMMIT DROP only fires at commit; drop now so a second load in the same transaction works.
+        cur.execute("DROP TABLE _repo_stage")
+    return loaded
+
+def write_repos(conn, repos):
+    repos = list(repos)
+    if len(repos) >= COPY_THRESHOLD:
+        return bulk_load_via_copy(conn, repos)
+    return upsert_repos_bulk(conn, repos)
 
 def export_csv(path: str):
-    import csv
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT repo_id, owner, name, full_name, stars, html_url, updated_at, first_seen FROM repositories ORDER BY stars DESC")
-            rows = cur.fetchall()
     directory = os.path.dirname(path)
     if directory:
         os.makedirs(directory, exist_ok=True)
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=rows[0].keys() if rows else ["repo_id","owner","name","full_name","stars","html_url","updated_at","first_seen"])
-        writer.writeheader()
-        for r in rows:
-            writer.writerow(r)
+    # Stream straight from the server with COPY; nothing is buffered row-by-row in Python.
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            with cur.copy(
+                "COPY (SELECT repo_id, owner, name, full_name, stars, html_url, updated_at, first_seen FROM repositories ORDER BY stars DESC, repo_id) TO STDOUT WITH (FORMAT CSV, HEADER)"
+            ) as cp:
+                with open(path, "wb") as f:
+                    for block in cp:
+                        f.write(block)
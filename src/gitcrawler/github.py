@@ -1,21 +1,41 @@
 from __future__ import annotations
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, timedelta
 from .config import SETTINGS
-from .utils import http_post_json, TransientError
+from .utils import http_post_json, RateLimitedError, TransientError
+import itertools
+import os
+import math
+import re
+import sqlite3
+import threading
 import time
 from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception_type
 
 GQL_ENDPOINT = "https://api.github.com/graphql"
 
+COUNT_CACHE_TTL_SECONDS = 7 * 24 * 3600
+CREATED_RANGE_RE = re.compile(r"^created:(\d{4}-\d{2}-\d{2})\.\.(\d{4}-\d{2}-\d{2})$")
+
+COUNT_BATCH_SIZE = 10
+SEARCH_RESULT_CAP = 1000
+SEARCH_PAGE_SIZE = 100
+# Below this many results a single walk is only a few pages; splitting would mostly add overlap.
+SPLIT_SORT_MIN = 500
+RATE_LIMIT_LOW_WATERMARK = 50
+ASSUMED_TOKEN_BUDGET = 5000
+RATE_LIMIT_FALLBACK_WAIT_SECONDS = 60
+
+_count_cache_enabled = True
+_count_memo: Dict[str, int] = {}
+_count_cache_conn: Optional[sqlite3.Connection] = None
+_count_cache_lock = threading.Lock()
+
 SEARCH_QUERY = '''
 query SearchRepos($q: String!, $cursor: String) {
-  rateLimit {
-    limit
-    cost
-    remaining
-    resetAt
-  }
-  search(query: $q, type: REPOSITORY, first: 100, after: $cursor) {
+  search(query: $q, type: REPOSITORY, first: %d, after: $cursor) {
     repositoryCount
     pageInfo { endCursor hasNextPage }
     nodes {
@@ -30,15 +50,7 @@ query SearchRepos($q: String!, $cursor: String) {
     }
   }
 }
-'''
-
-COUNT_QUERY = '''
-query CountRepos($q: String!) {
-  search(query: $q, type: REPOSITORY, first: 1) {
-    repositoryCount
-  }
-}
-'''
+''' % SEARCH_PAGE_SIZE
 
 SINGLE_REPO_QUERY = '''
 query Repo($owner: String!, $name: String!) {
@@ -64,18 +76,89 @@ query CurrentRateLimit {
 }
 '''
 
-def _headers():
-    token = SETTINGS.github_token or ""
-    if not token:
-        raise RuntimeError(
-            "Missing GitHub token. Set GITHUB_TOKEN in your environment or .env file."
-        )
+def _headers(token: str):
     return {
         "Authorization": f"Bearer {token}",
         "User-Agent": SETTINGS.user_agent,
         "Accept": "application/json",
     }
 
+class TokenPool:
+    """Sends each GraphQL call to the token with the most estimated rate-limit budget left."""
+
+    def __init__(self, tokens: Sequence[str], low_watermark: int = RATE_LIMIT_LOW_WATERMARK):
+        if not tokens:
+            raise RuntimeError(
+                "Missing GitHub token. Set GITHUB_TOKEN (or comma-separated GITHUB_TOKENS) in your environment or .env file."
+            )
+        self.low_watermark = low_watermark
+        # Built once per token and reused for every request.
+        self.headers: Dict[str, Dict[str, str]] = {t: _headers(t) for t in tokens}
+        # token -> [remaining (None until first observed), reset_at epoch seconds, calls since last observed]
+        self._state: Dict[str, List[Any]] = {t: [None, 0.0, 0] for t in tokens}
+        self._lock = threading.Lock()
+
+    def _pick(self) -> tuple[Optional[str], float]:
+        now = time.time()
+        best, best_budget, earliest_reset = None, -math.inf, math.inf
+        for token, state in self._state.items():
+            if state[0] is not None and state[1] and now >= state[1]:
+                state[0], state[2] = None, 0
+            # Unobserved tokens are assumed to start with a full budget, so calls spread across them too.
+            budget = ASSUMED_TOKEN_BUDGET - state[2] if state[0] is None else state[0]
+            if budget > best_budget:
+                best, best_budget = token, budget
+            if state[0] is not None:
+                earliest_reset = min(earliest_reset, state[1] or now)
+        if best_budget <= self.low_watermark and self._state[best][0] is not None:
+            return None, max(1.0, earliest_reset - now)
+        state = self._state[best]
+        if state[0] is None:
+            state[2] += 1
+        else:
+            state[0] -= 1
+        return best, 0.0
+
+    @contextmanager
+    def acquire(self):
+        while True:
+            with self._lock:
+                token, wait_seconds = self._pick()
+            if token is not None:
+                break
+            print(f"All GitHub tokens are near their rate limit; sleeping {wait_seconds:.0f}s until reset.", flush=True)
+            time.sleep(wait_seconds)
+        yield token
+
+    def update(self, token: str, rate_limit: Dict[str, Any]):
+        if "remaining" not in rate_limit:
+            return
+        with self._lock:
+            state = self._state[token]
+            state[0], state[2] = rate_limit["remaining"], 0
+            if rate_limit.get("reset_at"):
+                state[1] = rate_limit["reset_at"]
+
+    def mark_exhausted(self, token: str, reset_at: Optional[float]):
+        with self._lock:
+            state = self._state[token]
+            state[0], state[2] = 0, 0
+            if reset_at:
+                state[1] = reset_at
+            elif not state[1] or state[1] <= time.time():
+                state[1] = time.time() + RATE_LIMIT_FALLBACK_WAIT_SECONDS
+
+_token_pool: Optional[TokenPool] = None
+_token_pool_pid: Optional[int] = None
+
+def get_token_pool() -> TokenPool:
+    # Each worker process tracks its own budgets; the parent's lock must not be reused after fork.
+    global _token_pool, _token_pool_pid
+    if _token_pool is None or _token_pool_pid != os.getpid():
+        _token_pool = TokenPool(SETTINGS.github_tokens or tuple(t for t in [SETTINGS.github_token] if t))
+        _token_pool_pid = os.getpid()
+    return _token_pool
+
 @retry(
     reraise=True,
     stop=stop_after_attempt(5),
@@ -83,7 +166,18 @@ def _headers():
     retry=retry_if_exception_type(TransientError),
 )
 def gql(query: str, variables: dict) -> dict:
-    payload = http_post_json(GQL_ENDPOINT, _headers(), {"query": query, "variables": variables})
+    pool = get_token_pool()
+    with pool.acquire() as token:
+        try:
+            payload, rate_limit = http_post_json(GQL_ENDPOINT, pool.headers[token], {"query": query, "variables": variables})
+        except RateLimitedError as exc:
+            # Park this token; the retry below re-acquires, landing on another token or waiting for a reset.
+            pool.mark_exhausted(token, exc.reset_at)
+            raise
+    # Every response reports the budget of the token that sent it, so the pool never has to guess for long.
+    pool.update(token, rate_limit)
+    if any(err.get("type") == "RATE_LIMITED" for err in payload.get("errors") or []):
+        pool.mark_exhausted(token, rate_limit.get("reset_at"))
     if "errors" in payload and payload["errors"]:
         messages = "; ".join(err.get("message", "unknown error") for err in payload["errors"])
         raise TransientError(f"GraphQL error(s): {messages}")
@@ -91,33 +185,125 @@ def gql(query: str, variables: dict) -> dict:
         raise TransientError("GraphQL response missing 'data' field.")
     return payload
 
+def set_count_cache_enabled(enabled: bool):
+    global _count_cache_enabled
+    _count_cache_enabled = enabled
+
+def _count_cache():
+    global _count_cache_conn
+    if _count_cache_conn is None:
+        _count_cache_conn = sqlite3.connect(SETTINGS.count_cache_path, check_same_thread=False)
+        _count_cache_conn.execute("CREATE TABLE IF NOT EXISTS count_cache (q TEXT PRIMARY KEY, n INTEGER NOT NULL, ts INTEGER NOT NULL)")
+    return _count_cache_conn
+
+def _is_cacheable(q: str) -> bool:
+    # Only closed historical windows are stable; anything touching yesterday/today keeps growing.
+    m = CREATED_RANGE_RE.match(q)
+    return bool(m) and date.fromisoformat(m.group(2)) < date.today() - timedelta(days=1)
+
+def _batched_count_query(n: int) -> str:
+    params = ", ".join(f"$q{i}: String!" for i in range(n))
+    fields = "\n".join(f"  s{i}: search(query: $q{i}, type: REPOSITORY, first: 1) {{ repositoryCount }}" for i in range(n))
+    return f"query CountRepos({params}) {{\n{fields}\n}}"
+
+def _fetch_counts(qs: List[str]) -> List[int]:
+    # One aliased GraphQL document per request instead of one POST per query.
+    data = gql(_batched_count_query(len(qs)), {f"q{i}": q for i, q in enumerate(qs)})["data"]
+    return [data[f"s{i}"]["repositoryCount"] for i in range(len(qs))]
+
+def _cache_get(q: str) -> Optional[int]:
+    if q in _count_memo:
+        return _count_memo[q]
+    with _count_cache_lock:
+        row = _count_cache().execute("SELECT n, ts FROM count_cache WHERE q = ?", (q,)).fetchone()
+    if row and int(time.time()) - row[1] < COUNT_CACHE_TTL_SECONDS:
+        _count_memo[q] = row[0]
+        return row[0]
+    return None
+
+def _cache_put(q: str, n: int):
+    _count_memo[q] = n
+    with _count_cache_lock:
+        conn = _count_cache()
+        conn.execute("INSERT OR REPLACE INTO count_cache (q, n, ts) VALUES (?, ?, ?)", (q, n, int(time.time())))
+        conn.commit()
+
+def count_for_queries(qs: List[str]) -> List[int]:
+    results: List[Optional[int]] = [None] * len(qs)
+    misses: List[int] = []
+    for i, q in enumerate(qs):
+        if _count_cache_enabled and _is_cacheable(q):
+            results[i] = _cache_get(q)
+        if results[i] is None:
+            misses.append(i)
+    for offset in range(0, len(misses), COUNT_BATCH_SIZE):
+        batch = misses[offset: offset + COUNT_BATCH_SIZE]
+        for i, n in zip(batch, _fetch_counts([qs[i] for i in batch])):
+            results[i] = n
+            if _count_cache_enabled and _is_cacheable(qs[i]):
+                _cache_put(qs[i], n)
+    return results
+
 def count_for_query(q: str) -> int:
-    data = gql(COUNT_QUERY, {"q": q})
-    return data["data"]["search"]["repositoryCount"]
+    return count_for_queries([q])[0]
 
 def get_rate_limit() -> Dict[str, Any]:
     data = gql(RATE_LIMIT_QUERY, {})
     return data["data"]["rateLimit"]
 
-def iter_search(q: str, max_items: Optional[int] = None):
-    cursor = None
-    yielded = 0
+def _search_pages(q: str, cursor: Optional[str] = None):
     while True:
         data = gql(SEARCH_QUERY, {"q": q, "cursor": cursor})
-        rl = data["data"]["rateLimit"]
         search = data["data"]["search"]
+        yield search
+        if not search["pageInfo"]["hasNextPage"]:
+            break
+        cursor = search["pageInfo"]["endCursor"]
+
+def iter_search(q: str, max_items: Optional[int] = None, cursor: Optional[str] = None):
+    yielded = 0
+    for search in _search_pages(q, cursor):
         for n in search["nodes"]:
             yield n
             yielded += 1
             if max_items is not None and yielded >= max_items:
                 return
-        if not search["pageInfo"]["hasNextPage"]:
-            break
-        cursor = search["pageInfo"]["endCursor"]
-        # simple pacing to be nice
-        if rl and rl.get("remaining", 1) < 50:
-            # sleep until reset
-            time.sleep(5)
+
+def _fetch_pages(q: str, min_items: int):
+    """Fetch whole pages until at least min_items nodes; return them with the cursor to resume from (None when done)."""
+    nodes = []
+    for search in _search_pages(q):
+        nodes.extend(search["nodes"])
+        if len(nodes) >= min_items:
+            info = search["pageInfo"]
+            return nodes, info["endCursor"] if info["hasNextPage"] else None
+    return nodes, None
+
+def iter_search_concurrent(q: str, max_items: int, approx_count: int):
+    """Like iter_search, but page the stars-desc and stars-asc ends of large buckets in parallel."""
+    total = min(max_items, approx_count, SEARCH_RESULT_CAP)
+    if total <= SPLIT_SORT_MIN:
+        yield from iter_search(q, max_items=max_items)
+        return
+    half = math.ceil(total / 2)
+    desc_q = f"{q} sort:stars-desc"
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        desc = executor.submit(_fetch_pages, desc_q, half)
+        asc = executor.submit(lambda: list(iter_search(f"{q} sort:stars-asc", max_items=half)))
+        desc_nodes, desc_cursor = desc.result()
+        asc_nodes = asc.result()
+    # Tie groups (e.g. zero-star repos) can straddle both ends: dedupe, then keep walking desc from where it stopped.
+    topup = iter_search(desc_q, cursor=desc_cursor) if desc_cursor else ()
+    seen = set()
+    yielded = 0
+    for n in itertools.chain(desc_nodes, asc_nodes, topup):
+        if n["id"] in seen:
+            continue
+        seen.add(n["id"])
+        yield n
+        yielded += 1
+        if yielded >= total:
+            return
 
 def fetch_repo(owner: str, name: str):
     data = gql(SINGLE_REPO_QUERY, {"owner": owner, "name": name})
@@ -21,3 +21,6 @@ CREATE TABLE IF NOT EXISTS repo_star_history (
 
 CREATE INDEX IF NOT EXISTS idx_repositories_owner_name ON repositories(owner, name);
 CREATE INDEX IF NOT EXISTS idx_history_captured_at ON repo_star_history(captured_at);
+-- ON CONFLICT targets are already backed by the primary keys above (repo_id) and (repo_id, captured_at).
+-- Serves the export's ORDER BY without a sort step.
+CREATE INDEX IF NOT EXISTS idx_repositories_stars_desc ON repositories(stars DESC, repo_id);
@@ -1,20 +1,71 @@
-from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception_type
+import os
+import time
+from typing import Optional
+
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception_type, retry_if_not_exception_type
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE = 20
 
 class TransientError(Exception):
     pass
 
+class RateLimitedError(TransientError):
+    """The token used for the request is throttled; retrying with the same headers will not help."""
+
+    def __init__(self, message: str, reset_at: Optional[float] = None):
+        super().__init__(message)
+        self.reset_at = reset_at
+
+def _rate_limit_reset_at(r: requests.Response) -> Optional[float]:
+    retry_after = r.headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        return time.time() + int(retry_after)
+    reset = r.headers.get("X-RateLimit-Reset")
+    if reset and reset.isdigit():
+        return float(reset)
+    return None
+
+def _rate_limit_headers(r: requests.Response) -> dict:
+    # GitHub sends the budget of the token that made the call on every response, errors included.
+    rate_limit = {}
+    remaining = r.headers.get("X-RateLimit-Remaining")
+    if remaining and remaining.isdigit():
+        rate_limit["remaining"] = int(remaining)
+    reset = r.headers.get("X-RateLimit-Reset")
+    if reset and reset.isdigit():
+        rate_limit["reset_at"] = float(reset)
+    return rate_limit
+
+_SESSION: Optional[requests.Session] = None
+_SESSION_PID: Optional[int] = None
+
+def get_session() -> requests.Session:
+    # One keep-alive session per process: pooled sockets must not be shared with forked workers.
+    global _SESSION, _SESSION_PID
+    if _SESSION is None or _SESSION_PID != os.getpid():
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+        # Bodies are pre-serialised with orjson and sent as data=, so set the content type once here.
+        session.headers["Content-Type"] = "application/json"
+        _SESSION, _SESSION_PID = session, os.getpid()
+    return _SESSION
+
 @retry(
     reraise=True,
     stop=stop_after_attempt(8),
     wait=wait_exponential_jitter(initial=1, max=60),
-    retry=retry_if_exception_type(TransientError),
+    # Rate limits are handed back to the caller so it can switch tokens.
+    retry=retry_if_exception_type(TransientError) & retry_if_not_exception_type(RateLimitedError),
 )
-def http_post_json(url: str, headers: dict, json_body: dict) -> dict:
-    r = requests.post(url, headers=headers, json=json_body, timeout=60)
+def http_post_json(url: str, headers: dict, json_body: dict) -> tuple[dict, dict]:
+    """POST a JSON body; return the decoded response and its rate-limit headers (see _rate_limit_headers)."""
+    r = get_session().post(url, headers=headers, data=orjson.dumps(json_body), timeout=60)
     if r.status_code >= 500:
         raise TransientError(f"Server error {r.status_code}: {r.text[:200]}")
-    if r.status_code == 403 and "rate limit" in r.text.lower():
-        raise TransientError(f"Rate limited: {r.text[:200]}")
+    if r.status_code in (403, 429) and "rate limit" in r.text.lower():
+        raise RateLimitedError(f"Rate limited: {r.text[:200]}", reset_at=_rate_limit_reset_at(r))
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content), _rate_limit_headers(r)